@@ -1,15 +1,31 @@
+import base64
 import BaseHTTPServer
+import hashlib
+import httplib
+import imp
+import json
+import marshal
 import os
+import Queue
 import re
 import socket
 import sys
+import tempfile
+import threading
+import time
 import urllib
+import urllib2
+import urlparse
 
-from mercurial import cmdutil, error
+from mercurial import cmdutil, error, node, scmutil
 
 SERVER = 'https://codereview.adblockplus.org'
 UPLOADTOOL_URL = SERVER + '/static/upload.py'
 
+UPLOAD_CONNECTIONS = 8
+UPLOAD_RETRIES = 3
+UPLOAD_TIMEOUT = 60
+
 cmdtable = {}
 try:
     command = cmdutil.command(cmdtable)
@@ -17,11 +33,643 @@ except AttributeError:
     from mercurial import registrar
     command = registrar.command(cmdtable)
 
+
+def _replace_file(source, target):
+    # os.rename() won't overwrite existing files on Windows
+    try:
+        os.rename(source, target)
+    except OSError:
+        os.remove(target)
+        os.rename(source, target)
+
+
+def _write_atomically(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        _replace_file(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def _download_uploadtool(ui, upload_path):
+    ui.status('Downloading {0} to {1}.\n'.format(UPLOADTOOL_URL, upload_path))
+
+    # Download to a temporary file first so that an interrupted download
+    # doesn't leave a truncated upload tool behind
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(upload_path))
+    os.close(fd)
+    try:
+        urllib.urlretrieve(UPLOADTOOL_URL, temp_path)
+        with open(temp_path, 'rb') as file:
+            source = file.read()
+        try:
+            compile(source, upload_path, 'exec')
+        except SyntaxError:
+            raise error.Abort('Downloaded {0} is not a valid Python '
+                              'script.'.format(UPLOADTOOL_URL))
+        _replace_file(temp_path, upload_path)
+    except:
+        os.remove(temp_path)
+        raise
+
+    # Only record the checksum once the upload tool is in place, otherwise
+    # it wouldn't match the upload tool we failed to replace
+    _write_atomically(upload_path + '.sha256',
+                      hashlib.sha256(source).hexdigest())
+
+
+def _read_uploadtool(upload_path):
+    with open(upload_path, 'rb') as file:
+        source = file.read()
+    return source, hashlib.sha256(source).hexdigest()
+
+
+def _load_uploadtool(ui, upload_path, managed):
+    source, digest = _read_uploadtool(upload_path)
+    try:
+        with open(upload_path + '.sha256', 'rb') as file:
+            stored_digest = file.read().strip()
+    except IOError:
+        stored_digest = None
+
+    # The upload tool we manage is replaced if it doesn't match the download,
+    # older downloads without a checksum might be truncated. An upload tool
+    # at a configured path might have been changed on purpose.
+    if managed and stored_digest != digest:
+        ui.warn('{0} does not match the downloaded upload tool, downloading '
+                'it again.\n'.format(upload_path))
+        try:
+            _download_uploadtool(ui, upload_path)
+        except IOError as e:
+            ui.warn('Failed to download upload tool: {0}\n'.format(e))
+        else:
+            source, digest = _read_uploadtool(upload_path)
+    elif stored_digest is not None and stored_digest != digest:
+        ui.warn('{0} has changed since it was downloaded.\n'.format(
+            upload_path
+        ))
+
+    # The compiled upload tool is cached along with the checksum of its
+    # source, a changed upload tool invalidates the cache
+    cache_path = upload_path + 'c'
+    header = imp.get_magic() + digest
+    code = None
+    try:
+        with open(cache_path, 'rb') as file:
+            if file.read(len(header)) == header:
+                code = marshal.load(file)
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+
+    if code is None:
+        try:
+            code = compile(source, upload_path, 'exec')
+        except SyntaxError as e:
+            raise error.Abort('{0} is not a valid Python script: '
+                              '{1}'.format(upload_path, e))
+        try:
+            _write_atomically(cache_path, header + marshal.dumps(code))
+        except (IOError, OSError):
+            ui.debug('Failed to cache compiled upload tool in '
+                     '{0}.\n'.format(cache_path))
+
+    module = imp.new_module('hgreview_upload')
+    module.__file__ = upload_path
+    exec code in module.__dict__
+    return module
+
+
+class _ConnectionPool(object):
+    def __init__(self, url, size):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        else:
+            self._connection_class = httplib.HTTPConnection
+        self._host = parsed.netloc
+        self._prefix = ''
+        self._tunnel = None
+        self._headers = {}
+        self._idle = Queue.Queue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.size = size
+
+        # Go through the same proxy that the upload tool would use
+        proxy = urllib.getproxies().get(parsed.scheme)
+        if proxy and not urllib.proxy_bypass(parsed.hostname):
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            proxy = urlparse.urlsplit(proxy)
+            if proxy.username:
+                credentials = '{0}:{1}'.format(urllib.unquote(proxy.username),
+                                               urllib.unquote(proxy.password
+                                                              or ''))
+                self._headers['Proxy-Authorization'] = (
+                    'Basic ' + base64.b64encode(credentials)
+                )
+            default_port = 443 if proxy.scheme == 'https' else 80
+            proxy_host = '{0}:{1}'.format(proxy.hostname,
+                                          proxy.port or default_port)
+            if parsed.scheme == 'https':
+                # Tunnel HTTPS connections through the proxy
+                self._tunnel = self._host, self._headers
+                self._headers = {}
+            else:
+                self._prefix = 'http://' + self._host
+            self._host = proxy_host
+
+    def _connect(self):
+        connection = self._connection_class(self._host,
+                                            timeout=UPLOAD_TIMEOUT)
+        if self._tunnel:
+            host, headers = self._tunnel
+            connection.set_tunnel(host, headers=headers)
+        return connection
+
+    def request(self, method, path, body=None, headers=None):
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except Queue.Empty:
+                connection = self._connect()
+            try:
+                connection.request(method, self._prefix + path, body,
+                                   dict(self._headers, **(headers or {})))
+                response = connection.getresponse()
+                data = response.read()
+            except:
+                connection.close()
+                raise
+            self._idle.put(connection)
+            return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+class _ConnectionPools(object):
+    # Pools are created on first use, for the server URL as normalized by
+    # the upload tool
+    def __init__(self, size):
+        self.size = size
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        parsed = urlparse.urlsplit(url)
+        key = parsed.scheme, parsed.netloc
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = _ConnectionPool(url, self.size)
+            return self._pools[key]
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+
+
+class _LegacyProgress(object):
+    def __init__(self, ui, topic, unit, total):
+        self._ui = ui
+        self._topic = topic
+        self._unit = unit
+        self._total = total
+
+    def update(self, pos):
+        self._ui.progress(self._topic, pos, unit=self._unit, total=self._total)
+
+    def complete(self):
+        self._ui.progress(self._topic, None)
+
+
+def _makeprogress(ui, topic, unit, total):
+    # ui.progress() was replaced by ui.makeprogress() in Mercurial 4.7
+    if hasattr(ui, 'makeprogress'):
+        return ui.makeprogress(topic, unit=unit, total=total)
+    return _LegacyProgress(ui, topic, unit, total)
+
+
+def _send_with_retries(ui, pool, path, body, headers):
+    for attempt in range(UPLOAD_RETRIES + 1):
+        if attempt:
+            delay = 2 ** (attempt - 1)
+            ui.debug('Retrying {0} in {1} seconds.\n'.format(path, delay))
+            time.sleep(delay)
+        try:
+            status, data = pool.request('POST', path, body, headers)
+        except (socket.error, httplib.HTTPException) as e:
+            status = None
+            message = 'Failed to connect to server: {0}'.format(e)
+            continue
+        if status < 500:
+            break
+        message = 'Got {0} status code.'.format(status)
+    else:
+        return status, message
+
+    return status, data
+
+
+def _auth_headers(rpc_server, url):
+    # Authenticate like the upload tool, with its extra headers and cookies
+    headers = dict(getattr(rpc_server, 'extra_headers', {}))
+    cookie_jar = getattr(rpc_server, 'cookie_jar', None)
+    if cookie_jar is not None:
+        request = urllib2.Request(url)
+        cookie_jar.add_cookie_header(request)
+        if request.has_header('Cookie'):
+            headers['Cookie'] = request.get_header('Cookie')
+    return headers
+
+
+def _upload_base_files(ui, uploadtool, pool, issue, rpc_server, patch_list,
+                       patchset, options, files, report_progress=True):
+    max_size = getattr(uploadtool, 'MAX_UPLOAD_SIZE', 900 * 1024)
+    base_path = urlparse.urlsplit(rpc_server.host).path.rstrip('/')
+
+    # Expired credentials are renewed once for all uploads, like the upload
+    # tool does when it gets a 401 response
+    auth_lock = threading.Lock()
+    authentications = [0]
+
+    def send(path, body, content_type):
+        url = rpc_server.host.rstrip('/') + path[len(base_path):]
+        for renewed in (False, True):
+            generation = authentications[0]
+            headers = _auth_headers(rpc_server, url)
+            headers['Content-Type'] = content_type
+            status, data = _send_with_retries(ui, pool, path, body, headers)
+            if status != 401 or renewed:
+                break
+            with auth_lock:
+                if authentications[0] == generation:
+                    rpc_server._Authenticate()
+                    authentications[0] += 1
+
+        if status is not None and status != 200:
+            return 'Got {0} status code.'.format(status)
+        return data
+
+    jobs = Queue.Queue()
+    for file_id, filename in patch_list:
+        base_content, new_content, is_binary, status = files[filename]
+        if 'nobase' in file_id:
+            base_content = None
+            file_id = file_id[file_id.rfind('_') + 1:]
+        for content, is_base in ((base_content, True), (new_content, False)):
+            if content is not None:
+                jobs.put((filename, int(file_id), content, is_binary, status,
+                          is_base))
+    total = jobs.qsize()
+
+    def upload_file(filename, file_id, content, is_binary, status, is_base):
+        fields = [
+            ('filename', filename),
+            ('status', status),
+            ('is_binary', str(is_binary)),
+            ('is_current', str(not is_base)),
+        ]
+        if len(content) > max_size:
+            ui.status('Not uploading the {0} file for {1} because it\'s too '
+                      'large.\n'.format('base' if is_base else 'current',
+                                         filename))
+            fields.append(('file_too_large', '1'))
+            content = ''
+        fields.insert(2, ('checksum', hashlib.md5(content).hexdigest()))
+        if getattr(options, 'email', None):
+            fields.append(('user', options.email))
+        content_type, body = uploadtool.EncodeMultipartFormData(
+            fields, [('data', filename, content)]
+        )
+        path = '{0}/{1}/upload_content/{2}/{3}'.format(
+            base_path, int(issue), int(patchset), file_id
+        )
+        return send(path, body, content_type)
+
+    results = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                response = upload_file(*job)
+            except (Exception, SystemExit) as e:
+                response = str(e) or type(e).__name__
+            results.put((job[0], job[5], response))
+
+    for i in range(min(pool.size, total)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    failures = []
+    if report_progress:
+        progress = _makeprogress(ui, 'uploading', 'files', total)
+    for pos in range(total):
+        if report_progress:
+            progress.update(pos)
+        # Waiting with a timeout keeps the upload interruptible
+        while True:
+            try:
+                filename, is_base, response = results.get(timeout=0.1)
+                break
+            except Queue.Empty:
+                pass
+        if response.startswith('OK'):
+            ui.note('Uploaded {0} file for {1}.\n'.format(
+                'base' if is_base else 'current', filename
+            ))
+        else:
+            failures.append('{0}: {1}'.format(filename, response))
+    if report_progress:
+        progress.complete()
+
+    if failures:
+        raise error.Abort('Failed to upload files:\n' + '\n'.join(failures))
+
+
+class _UploadedContent(str):
+    # Stands in for base content that the server already has, only its
+    # checksum is needed unless the server asks for the content after all
+    def __new__(cls, checksum, load):
+        self = str.__new__(cls)
+        self.checksum = checksum
+        self.load = load
+        return self
+
+
+class _UploadedDigest(object):
+    def __init__(self, checksum):
+        self.checksum = checksum
+
+    def hexdigest(self):
+        return self.checksum
+
+
+class _ReviewCache(object):
+    # Remembers the base content checksums uploaded in each patch set, keyed
+    # by the file nodes of the base and new revision. Files that didn't
+    # change since an earlier patch set don't need to be read or uploaded.
+    # Without both revisions the cache is disabled.
+    def __init__(self, repo, base, end):
+        self._dir = os.path.join(repo.path, 'review-cache')
+        self._base = base
+        self._end = end
+        self._uploaded = {}
+
+    def _path(self, issue):
+        # Leave invalid issue numbers to the upload tool to complain about
+        if not str(issue).isdigit():
+            return None
+        return os.path.join(self._dir, '{0}.json'.format(int(issue)))
+
+    def _nodes(self, filename):
+        nodes = []
+        for ctx in (self._base, self._end):
+            filenode = ctx.manifest().get(filename)
+            nodes.append(filenode and node.hex(filenode))
+        return nodes
+
+    def load(self, issue):
+        path = self._path(issue)
+        if path is None:
+            return
+        try:
+            with open(path, 'rb') as file:
+                patchsets = json.load(file)
+        except (IOError, ValueError):
+            return
+        for patchset in sorted(patchsets, key=int):
+            for filename, entry in patchsets[patchset].iteritems():
+                self._uploaded[filename.encode('utf-8')] = [
+                    value and str(value) for value in entry
+                ]
+
+    def lookup(self, filename):
+        entry = self._uploaded.get(filename)
+        if entry is None or self._base is None or self._end is None:
+            return None
+        base_node, new_node, checksum, status = entry
+        if [base_node, new_node] != self._nodes(filename):
+            return None
+        return checksum, status
+
+    def record(self, issue, patchset, files, md5):
+        path = self._path(issue)
+        if self._base is None or self._end is None or path is None:
+            return
+        entries = {}
+        for filename, (base_content, new_content, is_binary,
+                       status) in files.iteritems():
+            if is_binary or base_content is None:
+                continue
+            base_node, new_node = self._nodes(filename)
+            if base_node is None:
+                continue
+            if isinstance(base_content, _UploadedContent):
+                checksum = base_content.checksum
+            else:
+                checksum = md5(base_content).hexdigest()
+            try:
+                filename = filename.decode('utf-8')
+            except UnicodeDecodeError:
+                continue
+            entries[filename] = [base_node, new_node, checksum, status]
+
+        try:
+            with open(path, 'rb') as file:
+                patchsets = json.load(file)
+        except (IOError, ValueError):
+            patchsets = {}
+        patchsets[str(int(patchset))] = entries
+        if not os.path.isdir(self._dir):
+            os.makedirs(self._dir)
+        _write_atomically(path, json.dumps(patchsets, indent=2,
+                                           sort_keys=True))
+
+
+def _install_uploader(ui, uploadtool, pools, current):
+    vcs_class = uploadtool.VersionControlSystem
+    original = vcs_class.UploadBaseFiles
+    original_md5 = uploadtool.md5
+
+    def UploadBaseFiles(self, issue, rpc_server, patch_list, patchset,
+                        options, files):
+        # The server normally has base content we didn't read, load it if
+        # it is requested anyway
+        for file_id, filename in patch_list:
+            base_content = files[filename][0]
+            if (isinstance(base_content, _UploadedContent) and
+                    'nobase' not in file_id):
+                files[filename] = (base_content.load(),) + files[filename][1:]
+
+        # Fall back to the upload tool's own implementation unless the upload
+        # tool has authenticated already, we reuse its credentials
+        if not (getattr(rpc_server, 'authenticated', False) or
+                getattr(rpc_server, 'extra_headers', {}).get('Authorization')):
+            original(self, issue, rpc_server, patch_list, patchset, options,
+                     files)
+        else:
+            pool = pools.get(rpc_server.host)
+            _upload_base_files(ui, uploadtool, pool, issue, rpc_server,
+                               patch_list, patchset, options, files,
+                               getattr(current, 'report_progress', True))
+        current.cache.record(issue, patchset, files, original_md5)
+
+    def md5(*args):
+        if args and isinstance(args[0], _UploadedContent):
+            return _UploadedDigest(args[0].checksum)
+        return original_md5(*args)
+
+    vcs_class.UploadBaseFiles = UploadBaseFiles
+    uploadtool.md5 = md5
+
+    hg_class = uploadtool.MercurialVCS
+    original_get_base_file = hg_class.GetBaseFile
+
+    def GetBaseFile(self, filename):
+        cached = current.cache.lookup(filename)
+        if cached is None:
+            return original_get_base_file(self, filename)
+        checksum, status = cached
+        ui.debug('Base content of {0} was uploaded before.\n'.format(filename))
+
+        def load():
+            return original_get_base_file(self, filename)[0]
+        return _UploadedContent(checksum, load), None, False, status
+
+    hg_class.GetBaseFile = GetBaseFile
+
+
+def _check_unknown_files(ui, repo):
+    # Same check as in the upload tool, which would otherwise ask once for
+    # every changeset of a stack. Like the upload tool, only the current
+    # directory is checked.
+    cwd = repo.getcwd()
+    unknown = [filename for filename in repo.status(unknown=True)[4]
+               if not cwd or filename.startswith(cwd + '/')]
+    if unknown:
+        ui.status('The following files are not added to version control:\n')
+        for filename in unknown:
+            ui.status(repo.pathto(filename) + '\n')
+        answer = ui.prompt('Are you sure to continue? (y/N) ', 'n')
+        if answer.lower() != 'y':
+            raise error.Abort('User aborted.')
+
+
+def _timed(current, phase, function):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current.timings[phase] += time.time() - start
+    return wrapper
+
+
+def _install_timers(uploadtool, current):
+    hg_class = uploadtool.MercurialVCS
+    vcs_class = uploadtool.VersionControlSystem
+    hg_class.GenerateDiff = _timed(current, 'diff', hg_class.GenerateDiff)
+    vcs_class.GetBaseFiles = _timed(current, 'diff', vcs_class.GetBaseFiles)
+
+    # All uploads of a session share the access token, only the first one
+    # goes through the OAuth flow
+    if hasattr(uploadtool, 'GetAccessToken'):
+        get_access_token = uploadtool.GetAccessToken
+        lock = threading.Lock()
+        tokens = {}
+
+        def GetAccessToken(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            with lock:
+                if not tokens.get(key):
+                    tokens[key] = get_access_token(*args, **kwargs)
+                return tokens[key]
+
+        uploadtool.GetAccessToken = _timed(current, 'auth', GetAccessToken)
+
+
+def _format_failure(e):
+    if isinstance(e, SystemExit):
+        if not e.code:
+            return 'the upload tool exited without uploading'
+        if isinstance(e.code, int):
+            return 'the upload tool exited with status {0}'.format(e.code)
+        return str(e.code)
+    if isinstance(e, error.Abort):
+        return str(e)
+    return '{0}: {1}'.format(type(e).__name__, e)
+
+
+def _format_timings(timings):
+    return ', '.join('{0} {1:.1f}s'.format(phase, timings[phase])
+                     for phase in ('diff', 'auth', 'upload'))
+
+
+def _run_uploads(ui, upload, count, concurrent, connections):
+    # Uploads the changesets of a stack, failures are collected so that the
+    # uploads that succeeded can still be reported
+    results = [None] * count
+    failures = []
+
+    def run(i):
+        try:
+            results[i] = upload(i)
+        except (Exception, SystemExit) as e:
+            failures.append((i, _format_failure(e)))
+
+    if not concurrent:
+        for i in range(count):
+            if failures:
+                failures.append((i, 'not uploaded after the previous '
+                                    'failure'))
+            else:
+                run(i)
+        return results, failures
+
+    slots = threading.BoundedSemaphore(connections)
+
+    def worker(i):
+        with slots:
+            run(i)
+
+    threads = []
+    for i in range(count):
+        thread = threading.Thread(target=worker, args=(i,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    # Only the main thread reports progress, for whole changesets
+    progress = _makeprogress(ui, 'uploading', 'changesets', count)
+    while True:
+        running = [thread for thread in threads if thread.is_alive()]
+        progress.update(count - len(running))
+        if not running:
+            break
+        running[0].join(0.1)
+    progress.complete()
+    return results, failures
+
+
 @command('review',
          [
              ('i', 'issue', '', 'If given, adds a patch set to this review, otherwise create a new one.', 'ISSUE'),
              ('r', 'revision', '', 'Revision to diff against or a revision range to upload.', 'REV'),
              ('c', 'change', '', 'A single revision to upload.', 'REV'),
+             ('s', 'stack', '', 'Upload each revision in this revision set as a separate review, or as consecutive patch sets if --issue is given.', 'REVSET'),
              ('t', 'title', '', 'New review subject or new patch set title.', 'TITLE'),
              ('m', 'message', '', 'New review description or new patch set message.', 'MESSAGE'),
              ('w', 'reviewers', '', 'Add reviewers (comma separated email addresses or @adblockplus.org user names).', 'REVIEWERS'),
@@ -36,8 +684,18 @@ def review(ui, repo, *paths, **opts):
       Uploads a review to https://codereview.adblockplus.org/ or updates an
       existing review request. This will always send mails for new reviews, when
       updating a review mails will only be sent if a message is given.
+
+      With --stack, each changeset in the revision set is uploaded in a single
+      session. Changesets become separate reviews which are uploaded
+      concurrently, or consecutive patch sets of the review given by --issue.
     '''
-    args = ['--oauth2', '--server', SERVER]
+    server_url = ui.config('review', 'server', SERVER)
+    connections = ui.configint('review', 'upload_connections',
+                               UPLOAD_CONNECTIONS)
+    if connections < 1:
+        raise error.Abort('review.upload_connections must be at least 1.')
+
+    args = ['--oauth2', '--server', server_url]
     if ui.debugflag:
         args.append('--noisy')
     elif ui.verbose:
@@ -49,33 +707,28 @@ def review(ui, repo, *paths, **opts):
         (not opts.get('issue') or opts.get('message'))):
         args.append('--send_mail')
 
-    if opts.get('revision') and opts.get('change'):
-        raise error.Abort('Ambiguous revision range, only one of --revision and --change can be specified.')
-    if opts.get('change'):
+    if len([opt for opt in ('revision', 'change', 'stack') if opts.get(opt)]) > 1:
+        raise error.Abort('Ambiguous revision range, only one of --revision, --change and --stack can be specified.')
+    if opts.get('stack'):
+        # Consecutive patch sets have to follow the history, regardless of
+        # the order of the revision set
+        changes = [repo[rev_no] for rev_no in sorted(repo.revs(opts['stack']))]
+        if not changes:
+            raise error.Abort('No revisions to upload in {0}.'.format(opts['stack']))
+    elif opts.get('change'):
         rev_no = repo.revs(opts['change']).first()
-        rev = repo[rev_no]
-        args.extend(['--rev', '{}:{}'.format(rev.parents()[0], rev)])
+        changes = [repo[rev_no]]
     elif opts.get('revision'):
-        args.extend(['--rev', opts['revision']])
+        changes = None
     else:
-        raise error.Abort('What should be reviewed? Either --revision or --change is required.')
+        raise error.Abort('What should be reviewed? Either --revision, --change or --stack is required.')
 
     if not opts.get('issue'):
         # New issue, make sure title and message are set
-        fulltitle = None
-
-        if not opts.get('title') and not opts.get('change'):
+        if not opts.get('title') and not changes:
             opts['title'] = ui.prompt('New review title: ', '')
-        elif not opts.get('title'):
-            rev_no = repo.revs(opts['change']).first()
-            fulltitle = repo[rev_no].description()
-            opts['title'] = fulltitle.rstrip().split('\n')[0]
-
-        if not opts['title'].strip():
-            raise error.Abort('No review title given.')
-
-        if not opts.get('message'):
-            opts['message'] = fulltitle or opts['title']
+            if not opts['title'].strip():
+                raise error.Abort('No review title given.')
 
         path = (ui.config('paths', 'default-push')
                 or ui.config('paths', 'default')
@@ -101,22 +754,69 @@ def review(ui, repo, *paths, **opts):
                      for u in re.split(r'\s*,\s*', opts[opt])]
             opts[opt] = ','.join(users)
 
-    for opt in ('issue', 'title', 'message', 'reviewers', 'cc', 'base_url'):
-        if opts.get(opt, ''):
-            args.extend(['--' + opt, opts[opt]])
+    # Separate issues are uploaded concurrently, the upload tool must not
+    # prompt from several threads at once, nor once for every changeset
+    concurrent = opts.get('stack') and not opts.get('issue')
+    if opts.get('stack') and not opts.get('assume_yes'):
+        _check_unknown_files(ui, repo)
+        opts['assume_yes'] = True
+
+    uploads = []
+    for change in changes or [None]:
+        upload_opts = dict(opts)
+        upload_args = list(args)
+        if change is not None:
+            upload_args.extend(['--rev', '{}:{}'.format(change.parents()[0],
+                                                        change)])
+            base, end = change.parents()[0], change
+        else:
+            upload_args.extend(['--rev', opts['revision']])
+            base = end = None
+            if opts.get('issue'):
+                # Only needed for the review cache, the upload tool
+                # interprets the revision range on its own
+                base_rev, _, end_rev = opts['revision'].partition(':')
+                try:
+                    base = scmutil.revsingle(repo, base_rev)
+                    if end_rev:
+                        end = scmutil.revsingle(repo, end_rev)
+                except (error.ParseError, error.RepoError, error.Abort):
+                    ui.debug('Not using the review cache for revision range '
+                             '{0}.\n'.format(opts['revision']))
+
+        # Take title and message from the changeset, patch sets only get
+        # a title when uploading a stack
+        if (change is not None and not opts.get('title') and
+                (not opts.get('issue') or opts.get('stack'))):
+            fulltitle = change.description()
+            upload_opts['title'] = fulltitle.rstrip().split('\n')[0]
+            if not opts.get('issue') and not opts.get('message'):
+                upload_opts['message'] = fulltitle
+
+        if not opts.get('issue'):
+            if not upload_opts['title'].strip():
+                raise error.Abort('No review title given.')
+            if not upload_opts.get('message'):
+                upload_opts['message'] = upload_opts['title']
 
-    for opt in ('private', 'assume_yes', 'print_diffs'):
-        if opts.get(opt, False):
-            args.append('--' + opt)
+        for opt in ('issue', 'title', 'message', 'reviewers', 'cc', 'base_url'):
+            if upload_opts.get(opt, ''):
+                upload_args.extend(['--' + opt, upload_opts[opt]])
 
-    args.extend(paths)
+        for opt in ('private', 'assume_yes', 'print_diffs'):
+            if upload_opts.get(opt, False):
+                upload_args.append('--' + opt)
 
-    upload_path = ui.config('review', 'uploadtool_path',
-                            os.path.join('~', '.hgreview_upload.py'))
+        upload_args.extend(paths)
+        uploads.append((change, upload_args, _ReviewCache(repo, base, end)))
+
+    upload_path = ui.config('review', 'uploadtool_path')
+    managed = not upload_path
+    if managed:
+        upload_path = os.path.join('~', '.hgreview_upload.py')
     upload_path = os.path.expanduser(upload_path)
     if not os.path.exists(upload_path):
-        ui.status('Downloading {0} to {1}.\n'.format(UPLOADTOOL_URL, upload_path))
-        urllib.urlretrieve(UPLOADTOOL_URL, upload_path)
+        _download_uploadtool(ui, upload_path)
 
     # Find an available port for our local server
     issue = None
@@ -126,10 +826,11 @@ def review(ui, repo, *paths, **opts):
             self.send_response(200)
             self.send_header('Content-type', 'text/javascript')
             self.end_headers()
-            self.wfile.write('location.href = "{0}";'.format(SERVER + '/' + issue))
+            self.wfile.write('location.href = "{0}";'.format(server_url + '/' + issue))
 
         def log_message(*args, **kwargs):
             pass
+    server = None
     for port in range(54770, 54780):
         try:
             server = BaseHTTPServer.HTTPServer(('localhost', port), RequestHandler)
@@ -138,10 +839,9 @@ def review(ui, repo, *paths, **opts):
             pass
 
     # Modify upload tool's auth response in order to redirect to the issue
-    scope = {}
-    execfile(upload_path, scope)
+    uploadtool = _load_uploadtool(ui, upload_path, managed)
     if server:
-        scope['AUTH_HANDLER_RESPONSE'] = '''\
+        uploadtool.AUTH_HANDLER_RESPONSE = '''\
 <html>
   <head>
     <title>Authentication Status</title>
@@ -166,9 +866,68 @@ def review(ui, repo, *paths, **opts):
 </html>
 ''' % port
 
-    # Run the upload tool
-    issue, patchset = scope['RealMain']([upload_path] + args)
+    # Upload file contents concurrently over persistent connections, the
+    # state of the upload running in the current thread is kept in current
+    pools = _ConnectionPools(connections)
+    current = threading.local()
+    _install_uploader(ui, uploadtool, pools, current)
+    _install_timers(uploadtool, current)
+
+    def upload(i):
+        change, upload_args, cache = uploads[i]
+        current.cache = cache
+        current.timings = timings = {'diff': 0.0, 'auth': 0.0}
+        current.report_progress = not concurrent
+        if opts.get('issue'):
+            cache.load(opts['issue'])
+        start = time.time()
+        issue, patchset = uploadtool.RealMain([upload_path] + upload_args)
+        timings['upload'] = (time.time() - start - timings['diff'] -
+                             timings['auth'])
+        return issue, patchset, timings
+
+    # Run the upload tool. Patch sets of the same issue have to be uploaded
+    # one after another, separate issues are uploaded concurrently.
+    start = time.time()
+    try:
+        if opts.get('stack'):
+            results, failures = _run_uploads(ui, upload, len(uploads),
+                                             concurrent, connections)
+        else:
+            results, failures = [upload(0)], []
+    finally:
+        pools.close()
+    elapsed = time.time() - start
+
+    succeeded = [(change, result)
+                 for (change, _, _), result in zip(uploads, results)
+                 if result is not None]
+    if opts.get('stack'):
+        totals = dict.fromkeys(('diff', 'auth', 'upload'), 0.0)
+        for change, (change_issue, patchset, timings) in succeeded:
+            ui.status('{0}: {1}/{2} (patch set {3}): {4}\n'.format(
+                change, server_url, change_issue, patchset,
+                _format_timings(timings)
+            ))
+            for phase in totals:
+                totals[phase] += timings[phase]
+        if succeeded:
+            # Concurrent uploads overlap, their phases add up to more than
+            # the time that passed
+            ui.status('Total: {0}; {1:.1f}s elapsed\n'.format(
+                _format_timings(totals), elapsed
+            ))
+    else:
+        ui.note('Timings: {0}\n'.format(_format_timings(results[0][2])))
 
     # Wait for the page to check in and retrieve issue URL
-    if server:
-        server.handle_request()
+    if succeeded:
+        issue = succeeded[0][1][0]
+        if server:
+            server.handle_request()
+
+    if failures:
+        raise error.Abort('Failed to upload changesets:\n' + '\n'.join(
+            '{0}: {1}'.format(uploads[i][0], message)
+            for i, message in sorted(failures)
+        ))
@@ -0,0 +1,574 @@
+# This file is part of Adblock Plus <https://adblockplus.org/>,
+# Copyright (C) 2017-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+import BaseHTTPServer
+import hashlib
+import SocketServer
+import threading
+import types
+
+import pytest
+from mercurial import error, ui as uimod
+
+import hgreview
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                           StandInHandler)
+        self.url = 'http://localhost:{0}'.format(self.server_port)
+        self.requests = []
+        self.clients = set()
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        # Called with the number of earlier requests for the same path,
+        # returns a status code or None to drop the connection
+        self.respond = lambda attempt: 200
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with server.lock:
+            attempt = len([path for path, _, _ in server.requests
+                           if path == self.path])
+            server.requests.append((self.path, self.headers, body))
+            server.clients.add(self.client_address)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            # Keeps requests overlapping, time.sleep() is patched below
+            threading.Event().wait(0.05)
+            status = server.respond(attempt)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+        if status is None:
+            self.close_connection = True
+            return
+        data = 'OK' if status == 200 else 'ERROR'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Progress(object):
+    def __init__(self):
+        self.positions = []
+        self.completed = False
+
+    def update(self, pos, **kwargs):
+        self.positions.append(pos)
+
+    def complete(self):
+        self.completed = True
+
+
+class LegacyUI(object):
+    # Mercurial before 4.7 only has ui.progress()
+    def __init__(self):
+        self.positions = []
+
+    def debug(self, message):
+        pass
+
+    note = status = debug
+
+    def progress(self, topic, pos, **kwargs):
+        self.positions.append(pos)
+
+
+class UploadTool(object):
+    MAX_UPLOAD_SIZE = 1024
+
+    @staticmethod
+    def EncodeMultipartFormData(fields, files):
+        return 'multipart/form-data', repr((fields, files))
+
+
+class RpcServer(object):
+    def __init__(self, host, authenticated=True, extra_headers=None,
+                 cookie_jar=None):
+        self.host = host
+        self.authenticated = authenticated
+        if extra_headers is None:
+            extra_headers = {'Authorization': 'OAuth token'}
+        self.extra_headers = extra_headers
+        self.cookie_jar = cookie_jar
+        self.authentications = 0
+
+    def _Authenticate(self):
+        self.authentications += 1
+        self.extra_headers['Authorization'] = 'OAuth renewed'
+
+
+class CookieJar(object):
+    def add_cookie_header(self, request):
+        request.add_unredirected_header('Cookie', 'dev_appserver_login=x')
+
+
+class Options(object):
+    email = None
+
+
+class NoCache(object):
+    def lookup(self, filename):
+        return None
+
+    def record(self, issue, patchset, files, md5):
+        pass
+
+
+class Current(object):
+    cache = NoCache()
+
+
+def make_uploadtool():
+    uploadtool = types.ModuleType('uploadtool')
+    uploadtool.fallback_calls = []
+
+    class VersionControlSystem(object):
+        def UploadBaseFiles(self, *args):
+            uploadtool.fallback_calls.append(args)
+
+    class MercurialVCS(VersionControlSystem):
+        def GetBaseFile(self, filename):
+            return 'base', None, False, 'M'
+
+    uploadtool.VersionControlSystem = VersionControlSystem
+    uploadtool.MercurialVCS = MercurialVCS
+    uploadtool.md5 = hashlib.md5
+    uploadtool.MAX_UPLOAD_SIZE = UploadTool.MAX_UPLOAD_SIZE
+    uploadtool.EncodeMultipartFormData = UploadTool.EncodeMultipartFormData
+    return uploadtool
+
+
+def upload_with_uploadtool(rpc_server, files):
+    uploadtool = make_uploadtool()
+    pools = hgreview._ConnectionPools(2)
+    hgreview._install_uploader(uimod.ui(), uploadtool, pools, Current())
+    patch_list = [(str(i), filename)
+                  for i, filename in enumerate(sorted(files), 1)]
+    try:
+        uploadtool.MercurialVCS().UploadBaseFiles('10', rpc_server,
+                                                  patch_list, 2, Options(),
+                                                  files)
+    finally:
+        pools.close()
+    return uploadtool
+
+
+@pytest.fixture
+def server():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(hgreview.time, 'sleep', lambda seconds: None)
+
+
+def warnings(ui, function, *args):
+    ui.pushbuffer(error=True)
+    try:
+        result = function(ui, *args)
+    finally:
+        messages = ui.popbuffer()
+    return result, messages
+
+
+def upload(server, files, patch_list=None, size=4, ui=None,
+           rpc_server=None):
+    if patch_list is None:
+        patch_list = [(str(i), filename)
+                      for i, filename in enumerate(sorted(files), 1)]
+    if ui is None:
+        ui = uimod.ui()
+    pool = hgreview._ConnectionPool(server.url, size)
+    try:
+        hgreview._upload_base_files(ui, UploadTool, pool, '10',
+                                    rpc_server or RpcServer(server.url),
+                                    patch_list, 2, Options(), files)
+    finally:
+        pool.close()
+    return ui
+
+
+def test_concurrent_upload(server):
+    files = {'file{0}'.format(i): ('base', 'new', True, 'M')
+             for i in range(20)}
+    upload(server, files)
+
+    paths = sorted(path for path, _, _ in server.requests)
+    assert paths == sorted(['/10/upload_content/2/{0}'.format(i)
+                            for i in range(1, 21)] * 2)
+    assert all(headers['Authorization'] == 'OAuth token'
+               for _, headers, _ in server.requests)
+    assert 1 < server.max_active <= 4
+    assert len(server.clients) <= 4
+
+
+def test_progress(server, monkeypatch):
+    ui = uimod.ui()
+    progress = Progress()
+    monkeypatch.setattr(ui, 'makeprogress',
+                        lambda topic, unit, total: progress)
+    upload(server, {'foo': ('base', 'new', True, 'M')}, ui=ui)
+    assert progress.positions == [0, 1]
+    assert progress.completed
+
+
+def test_legacy_progress(server):
+    ui = upload(server, {'foo': ('base', 'new', True, 'M')}, ui=LegacyUI())
+    assert ui.positions == [0, 1, None]
+
+
+def test_upload_to_upload_tool_server(server):
+    # The pool connects to the server URL normalized by the upload tool
+    uploadtool = upload_with_uploadtool(RpcServer(server.url),
+                                        {'foo': ('base', None, False, 'M')})
+    assert [path for path, _, _ in server.requests] == [
+        '/10/upload_content/2/1',
+    ]
+    assert uploadtool.fallback_calls == []
+
+
+def test_cookie_authentication(server):
+    # The upload tool authenticates against a local server with a cookie
+    rpc_server = RpcServer(server.url, extra_headers={},
+                           cookie_jar=CookieJar())
+    uploadtool = upload_with_uploadtool(rpc_server,
+                                        {'foo': ('base', None, False, 'M')})
+    assert uploadtool.fallback_calls == []
+    headers = server.requests[0][1]
+    assert headers['Cookie'] == 'dev_appserver_login=x'
+    assert 'Authorization' not in headers
+
+
+def test_unauthenticated_falls_back(server):
+    rpc_server = RpcServer(server.url, authenticated=False, extra_headers={})
+    uploadtool = upload_with_uploadtool(rpc_server,
+                                        {'foo': ('base', None, False, 'M')})
+    assert len(uploadtool.fallback_calls) == 1
+    assert server.requests == []
+
+
+def test_reauthenticate_on_unauthorized(server):
+    server.respond = lambda attempt: 401 if attempt == 0 else 200
+    rpc_server = RpcServer(server.url)
+    upload(server, {'foo': ('base', None, False, 'M')}, rpc_server=rpc_server)
+    assert rpc_server.authentications == 1
+    assert [headers['Authorization']
+            for _, headers, _ in server.requests] == ['OAuth token',
+                                                      'OAuth renewed']
+
+
+def test_unauthorized_after_reauthentication_aborts(server):
+    server.respond = lambda attempt: 401
+    rpc_server = RpcServer(server.url)
+    with pytest.raises(error.Abort):
+        upload(server, {'foo': ('base', None, False, 'M')},
+               rpc_server=rpc_server)
+    assert rpc_server.authentications == 1
+    assert len(server.requests) == 2
+
+
+def test_nobase_skips_base_content(server):
+    files = {'foo': ('base', None, False, 'M')}
+    upload(server, files, [('nobase_1', 'foo')])
+    assert server.requests == []
+
+
+def test_retry_on_server_error(server):
+    server.respond = lambda attempt: 503 if attempt < 2 else 200
+    upload(server, {'foo': ('base', None, False, 'M')})
+    assert len(server.requests) == 3
+
+
+def test_retry_on_dropped_connection(server):
+    server.respond = lambda attempt: None if attempt == 0 else 200
+    upload(server, {'foo': ('base', None, False, 'M')})
+    assert len(server.requests) == 2
+
+
+def test_give_up_after_retries(server):
+    server.respond = lambda attempt: 503
+    with pytest.raises(error.Abort):
+        upload(server, {'foo': ('base', None, False, 'M')})
+    assert len(server.requests) == hgreview.UPLOAD_RETRIES + 1
+
+
+def test_client_error_aborts(server):
+    server.respond = lambda attempt: 403
+    with pytest.raises(error.Abort):
+        upload(server, {'foo': ('base', None, False, 'M')})
+    assert len(server.requests) == 1
+
+
+def test_http_proxy(server, monkeypatch):
+    monkeypatch.setenv('http_proxy', server.url)
+    monkeypatch.setenv('no_proxy', '')
+    pool = hgreview._ConnectionPool('http://codereview.invalid', 1)
+    try:
+        assert pool.request('POST', '/1', 'data') == (200, 'OK')
+    finally:
+        pool.close()
+    assert server.requests[0][0] == 'http://codereview.invalid/1'
+
+
+@pytest.fixture
+def download(monkeypatch):
+    downloads = []
+
+    def urlretrieve(url, path):
+        downloads.append(url)
+        with open(path, 'w') as file:
+            file.write('VERSION = "downloaded"\n')
+
+    monkeypatch.setattr(hgreview.urllib, 'urlretrieve', urlretrieve)
+    return downloads
+
+
+def test_download_uploadtool(tmpdir, download):
+    path = str(tmpdir.join('upload.py'))
+    hgreview._download_uploadtool(uimod.ui(), path)
+    module = hgreview._load_uploadtool(uimod.ui(), path, True)
+    assert module.VERSION == 'downloaded'
+    assert download == [hgreview.UPLOADTOOL_URL]
+    assert tmpdir.join('upload.pyc').check()
+
+
+def test_changed_managed_uploadtool_is_downloaded_again(tmpdir, download):
+    path = tmpdir.join('upload.py')
+    hgreview._download_uploadtool(uimod.ui(), str(path))
+    path.write('VERSION = "trunc')
+    module, messages = warnings(uimod.ui(), hgreview._load_uploadtool,
+                                str(path), True)
+    assert module.VERSION == 'downloaded'
+    assert len(download) == 2
+    assert 'downloading it again' in messages
+
+
+def test_managed_uploadtool_without_checksum_is_downloaded_again(tmpdir,
+                                                                 download):
+    path = tmpdir.join('upload.py')
+    path.write('VERSION = "old"\n')
+    module = hgreview._load_uploadtool(uimod.ui(), str(path), True)
+    assert module.VERSION == 'downloaded'
+    assert len(download) == 1
+
+
+def test_changed_configured_uploadtool_is_used(tmpdir, download):
+    path = tmpdir.join('upload.py')
+    hgreview._download_uploadtool(uimod.ui(), str(path))
+    hgreview._load_uploadtool(uimod.ui(), str(path), False)
+    path.write('VERSION = "custom"\n')
+    module, messages = warnings(uimod.ui(), hgreview._load_uploadtool,
+                                str(path), False)
+    assert module.VERSION == 'custom'
+    assert len(download) == 1
+    assert 'has changed' in messages
+
+
+def test_invalid_configured_uploadtool(tmpdir):
+    path = tmpdir.join('upload.py')
+    path.write('VERSION = "trunc')
+    with pytest.raises(error.Abort):
+        hgreview._load_uploadtool(uimod.ui(), str(path), False)
+
+
+class Repo(object):
+    def __init__(self, path):
+        self.path = path
+
+
+class Context(object):
+    def __init__(self, manifest):
+        self._manifest = manifest
+
+    def manifest(self):
+        return self._manifest
+
+
+BASE = Context({'foo': '\x01' * 20, 'bar': '\x02' * 20,
+                'binary': '\x03' * 20, 'source': '\x05' * 20})
+END = Context({'foo': '\x11' * 20, 'bar': '\x12' * 20,
+               'binary': '\x13' * 20, 'added': '\x14' * 20,
+               'copied': '\x15' * 20})
+FILES = {
+    'foo': ('foo base', None, False, 'M'),
+    'bar': ('bar base', None, False, 'M'),
+    'binary': ('\0', '\0\0', True, 'M'),
+    'added': ('', None, False, 'A'),
+    'copied': ('source base', None, False, 'A +'),
+}
+
+
+def review_cache(tmpdir, base=BASE, end=END, issue=None):
+    cache = hgreview._ReviewCache(Repo(str(tmpdir)), base, end)
+    if issue is not None:
+        cache.load(issue)
+    return cache
+
+
+def test_review_cache_round_trip(tmpdir):
+    review_cache(tmpdir).record('10', 1, FILES, hashlib.md5)
+    cache = review_cache(tmpdir, issue='10')
+    assert cache.lookup('foo') == (hashlib.md5('foo base').hexdigest(), 'M')
+    assert cache.lookup('bar') == (hashlib.md5('bar base').hexdigest(), 'M')
+    assert review_cache(tmpdir, issue='11').lookup('foo') is None
+
+
+def test_review_cache_misses_changed_nodes(tmpdir):
+    review_cache(tmpdir).record('10', 1, FILES, hashlib.md5)
+    end = Context(dict(END.manifest(), foo='\x21' * 20))
+    base = Context(dict(BASE.manifest(), bar='\x22' * 20))
+    cache = review_cache(tmpdir, base, end, issue='10')
+    assert cache.lookup('foo') is None
+    assert cache.lookup('bar') is None
+
+
+def test_review_cache_skips_binary_added_and_copied_files(tmpdir):
+    review_cache(tmpdir).record('10', 1, FILES, hashlib.md5)
+    cache = review_cache(tmpdir, issue='10')
+    for filename in ('binary', 'added', 'copied'):
+        assert cache.lookup(filename) is None
+
+
+def test_review_cache_records_uploaded_content(tmpdir):
+    # Content that was referenced by checksum is recorded again
+    checksum = hashlib.md5('foo base').hexdigest()
+    files = {'foo': (hgreview._UploadedContent(checksum, None), None, False,
+                     'M')}
+    review_cache(tmpdir).record('10', 2, files, hashlib.md5)
+    assert review_cache(tmpdir, issue='10').lookup('foo') == (checksum, 'M')
+
+
+def test_review_cache_without_end_revision(tmpdir):
+    review_cache(tmpdir, end=None).record('10', 1, FILES, hashlib.md5)
+    assert not tmpdir.join('review-cache').check()
+    review_cache(tmpdir).record('10', 1, FILES, hashlib.md5)
+    assert review_cache(tmpdir, end=None, issue='10').lookup('foo') is None
+
+
+def test_review_cache_invalid_issue(tmpdir):
+    url = 'https://codereview.adblockplus.org/10/'
+    cache = review_cache(tmpdir, issue=url)
+    cache.record(url, 1, FILES, hashlib.md5)
+    assert cache.lookup('foo') is None
+    assert not tmpdir.join('review-cache').check()
+
+
+def test_run_stack_sequentially():
+    def upload(i):
+        if i == 1:
+            raise SystemExit()
+        return ('10', i + 1, {})
+
+    results, failures = hgreview._run_uploads(uimod.ui(), upload, 3, False, 4)
+    assert results == [('10', 1, {}), None, None]
+    assert failures == [
+        (1, 'the upload tool exited without uploading'),
+        (2, 'not uploaded after the previous failure'),
+    ]
+
+
+def test_run_stack_concurrently(monkeypatch):
+    active = []
+    max_active = []
+    lock = threading.Lock()
+
+    def upload(i):
+        with lock:
+            active.append(i)
+            max_active.append(len(active))
+        threading.Event().wait(0.05)
+        with lock:
+            active.remove(i)
+        if i == 2:
+            raise error.Abort('boom')
+        if i == 4:
+            raise SystemExit(1)
+        return (str(i), 1, {})
+
+    ui = uimod.ui()
+    progress = Progress()
+    monkeypatch.setattr(ui, 'makeprogress',
+                        lambda topic, unit, total: progress)
+    results, failures = hgreview._run_uploads(ui, upload, 6, True, 2)
+    assert results == [('0', 1, {}), ('1', 1, {}), None, ('3', 1, {}), None,
+                       ('5', 1, {})]
+    assert sorted(failures) == [(2, 'boom'),
+                                (4, 'the upload tool exited with status 1')]
+    assert max(max_active) == 2
+    assert progress.completed
+
+
+class UnknownFilesRepo(object):
+    def __init__(self, cwd):
+        self.cwd = cwd
+
+    def getcwd(self):
+        return self.cwd
+
+    def status(self, unknown=False):
+        return [[], [], [], [], ['junk', 'sub/junk', 'subdir/junk']]
+
+    def pathto(self, filename):
+        return filename[len(self.cwd) + 1:]
+
+
+def prompt_unknown_files(cwd, answer):
+    ui = uimod.ui()
+    prompts = []
+    ui.prompt = lambda message, default: prompts.append(message) or answer
+    ui.pushbuffer()
+    try:
+        hgreview._check_unknown_files(ui, UnknownFilesRepo(cwd))
+    finally:
+        output = ui.popbuffer()
+    return prompts, output
+
+
+def test_unknown_files_in_current_directory():
+    prompts, output = prompt_unknown_files('sub', 'Y')
+    assert len(prompts) == 1
+    assert output.splitlines()[1:] == ['junk']
+    with pytest.raises(error.Abort):
+        prompt_unknown_files('sub', 'n')
+
+
+def test_unknown_files_outside_current_directory():
+    prompts, output = prompt_unknown_files('other', 'n')
+    assert prompts == []
+    assert output == ''